@@ -0,0 +1,51 @@
+"""One-time export of Mask R-CNN to a TensorRT engine.
+
+Run this once on the deployment GPU:
+    python build_trt_engine.py
+
+It exports the torchvision Mask R-CNN to ONNX and then compiles it with
+trtexec into maskrcnn.plan (FP16). detect_color_shape.py picks the plan
+up automatically when it sits next to the script.
+"""
+
+import os
+import subprocess
+
+import torch
+import torchvision
+
+ONNX_PATH = os.path.join(os.path.dirname(__file__), "maskrcnn.onnx")
+PLAN_PATH = os.path.join(os.path.dirname(__file__), "maskrcnn.plan")
+
+
+def export_onnx():
+    model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights="COCO_V1")
+    model.eval()
+    dummy = torch.rand(1, 3, 800, 1066)
+    torch.onnx.export(
+        model, dummy, ONNX_PATH,
+        opset_version=17,
+        input_names=["input"],
+        output_names=["boxes", "labels", "scores", "masks"],
+        dynamic_axes={"input": {2: "H", 3: "W"}},
+    )
+    print(f"[done] ONNX exported to {ONNX_PATH}")
+
+
+def build_engine():
+    cmd = [
+        "trtexec",
+        f"--onnx={ONNX_PATH}",
+        "--fp16",
+        f"--saveEngine={PLAN_PATH}",
+        "--minShapes=input:1x3x480x640",
+        "--optShapes=input:1x3x800x1066",
+        "--maxShapes=input:1x3x1344x1344",
+    ]
+    subprocess.run(cmd, check=True)
+    print(f"[done] TensorRT engine saved to {PLAN_PATH}")
+
+
+if __name__ == "__main__":
+    export_onnx()
+    build_engine()
@@ -0,0 +1,98 @@
+"""Small inference server keeping Mask R-CNN warm in memory.
+
+Running detect_color_shape.py per image pays the weight load (and
+torch.compile warmup) every time. Instead run
+
+    uvicorn serve:app --host 0.0.0.0 --port 8000
+
+from this directory and POST raw JPEG/PNG bytes to /detect. The model
+is loaded once at import; concurrent requests are micro-batched
+(max 8 frames, max 10 ms wait) into a single forward pass.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import cv2
+import numpy as np
+from fastapi import FastAPI, Request
+
+import detect_color_shape as dcs
+
+MAX_BATCH = 8
+MAX_WAIT_S = 0.010
+
+
+# ✅ Holds the loaded model; turns decoded frames into detection dicts
+class Detector:
+    def __call__(self, images):
+        tensors, outputs = dcs.detect(images)
+        return [dcs.annotate(image, image_t, output)
+                for image, image_t, output in zip(images, tensors, outputs)]
+
+
+detector = Detector()
+_queue = None
+_worker_task = None
+
+
+# ✅ Micro-batcher: gather concurrent requests, run one batched forward pass
+async def _batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _queue.get()]
+        deadline = loop.time() + MAX_WAIT_S
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        images = [image for image, _ in batch]
+        try:
+            results = await asyncio.to_thread(detector, images)
+            for (_, fut), detections in zip(batch, results):
+                # The future is cancelled if the client disconnected mid-wait;
+                # setting a result on it would raise and poison the batchmates
+                if not fut.done():
+                    fut.set_result(detections)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+
+@asynccontextmanager
+async def _lifespan(app):
+    # Keep a strong reference to the worker — the event loop only holds
+    # tasks weakly, and a collected worker would strand every request
+    global _queue, _worker_task
+    _queue = asyncio.Queue()
+    _worker_task = asyncio.create_task(_batch_worker())
+    yield
+    _worker_task.cancel()
+
+
+app = FastAPI(lifespan=_lifespan)
+
+
+@app.post("/detect")
+async def detect_endpoint(request: Request):
+    body = await request.body()
+    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return {"error": "could not decode image"}
+
+    # Same downscale rule as detect_color_shape.load_image
+    h, w = image.shape[:2]
+    s = dcs.MIN_SIDE / min(h, w)
+    if s < 1:
+        image = cv2.resize(image, (int(w * s), int(h * s)),
+                           interpolation=cv2.INTER_AREA)
+
+    fut = asyncio.get_running_loop().create_future()
+    await _queue.put((image, fut))
+    detections = await fut
+    return {"detections": detections}